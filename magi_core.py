@@ -1,8 +1,16 @@
 import asyncio
-import json
+import atexit
+import concurrent.futures
+import functools
+import hashlib
+import os
+import pathlib
+import subprocess
 import time
 import sys
 
+import orjson
+
 # --- CONFIGURATION ---
 AGENTS = {
     "melchior-1": "melchior-1",
@@ -12,155 +20,464 @@ AGENTS = {
 
 TIMEOUT_SECONDS = 120  # Reduced to avoid hanging too long
 
+OLLAMA_URL = "http://localhost:11434/api/generate"
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Handed to Ollama's constrained decoder via the "format" field: the server
+# guarantees the model output matches this schema, so no Python-side validation
+# round-trip is needed.
+OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "claim": {"type": "string"},
+        "confidence": {"type": "number"},
+        "failure_modes": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["claim", "confidence"],
+}
+# Keep the models resident indefinitely so the KV-prefix cache survives across
+# rounds AND across user queries in a long-running session. Tradeoff: all three
+# models stay pinned in (V)RAM until ollama is restarted or another model
+# evicts them — drop this back to a duration like "30m" on memory-tight hosts.
+KEEP_ALIVE = -1
+
+_CACHE_DIR = pathlib.Path(".magi_cache")
+_CACHE_VERSION = "3"  # Bump whenever prompt templates change to invalidate old entries
+
+CONSENSUS_THRESHOLD = 0.85  # Min Round-1 confidence (all nodes) that lets us skip Round 2
+
+_SEMANTIC_THRESHOLD = 0.92  # Cosine similarity above which two prompts count as the same question
+_SEMANTIC_DIM = 384  # all-MiniLM-L6-v2 embedding width
+
 # --- CORE FUNCTIONS ---
 
-async def call_agent(name: str, model: str, prompt: str):
-    """Calls Ollama via subprocess."""
-    start_time = time.time()
-    process = None
+def _cache_path(model: str, prompt: str):
+    """Maps (model, prompt) to a cache file. Version byte keeps stale templates out."""
+    key = hashlib.sha256(f"{_CACHE_VERSION}\0{model}\0{prompt}".encode()).hexdigest()
+    return _CACHE_DIR / f"{key}.json"
 
+def _cache_load(cache_file):
     try:
-        process = await asyncio.create_subprocess_exec(
-            "ollama",
-            "run",
-            model,
-            "--format", "json",
-            "--hidethinking",  # Ensure no thought process leaks into output
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        return orjson.loads(cache_file.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def _cache_store(cache_file, result):
+    try:
+        _CACHE_DIR.mkdir(exist_ok=True)
+        tmp = cache_file.with_suffix(".tmp")
+        tmp.write_bytes(orjson.dumps(result))
+        os.replace(tmp, cache_file)  # Atomic: readers never see a half-written entry
+    except OSError:
+        pass  # Caching is best-effort; never fail the call over it
+
+# --- SEMANTIC CACHE ---
+# Catches paraphrases of earlier prompts ("What is X?" vs "Tell me about X") that
+# the exact-match cache above misses, and reuses the full triple-agent result.
+
+_semantic_vectors = None  # N x _SEMANTIC_DIM float32 matrix, parallel to _semantic_entries
+_semantic_entries = None
+
+@functools.lru_cache(maxsize=1)
+def _embedder():
+    # Deferred import: sentence-transformers drags in torch and costs ~200ms of
+    # model load, so it is only paid on the first cache miss of the process
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+def _semantic_embed(prompt: str):
+    import numpy as np
+    return np.asarray(_embedder().encode(prompt), dtype=np.float32)
+
+def _semantic_index():
+    """Loads (or initializes) the prompt-embedding index, once per process."""
+    global _semantic_vectors, _semantic_entries
+    if _semantic_entries is None:
+        import numpy as np
+        try:
+            _semantic_vectors = np.load(_CACHE_DIR / "embeddings.npy")
+            _semantic_entries = orjson.loads((_CACHE_DIR / "semantic_entries.json").read_bytes())
+        except (OSError, ValueError):
+            _semantic_vectors = np.empty((0, _SEMANTIC_DIM), dtype=np.float32)
+            _semantic_entries = []
+        atexit.register(_semantic_save)
+    return _semantic_vectors, _semantic_entries
+
+def _semantic_save():
+    try:
+        import numpy as np
+        _CACHE_DIR.mkdir(exist_ok=True)
+        np.save(_CACHE_DIR / "embeddings.npy", _semantic_vectors)
+        (_CACHE_DIR / "semantic_entries.json").write_bytes(orjson.dumps(_semantic_entries))
+    except OSError:
+        pass
+
+def _semantic_lookup(user_prompt: str):
+    """Returns (query_vector, cached_results_or_None) for a prompt."""
+    import numpy as np
+    vectors, entries = _semantic_index()
+    query = _semantic_embed(user_prompt)
+    if entries:
+        scores = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-9)
+        best = int(scores.argmax())
+        if scores[best] > _SEMANTIC_THRESHOLD:
+            return query, entries[best]["results"]
+    return query, None
+
+def _semantic_store(query_vec, user_prompt, results):
+    global _semantic_vectors
+    import numpy as np
+    vectors, entries = _semantic_index()
+    _semantic_vectors = np.vstack([vectors, query_vec[None, :]])
+    entries.append({"prompt": user_prompt, "results": results})
+
+_SESSION = None
 
-        stdout, stderr = await asyncio.wait_for(
-            process.communicate(prompt.encode()),
-            timeout=TIMEOUT_SECONDS
+async def _session():
+    """Lazily creates the shared HTTP session so every call reuses one connection."""
+    global _SESSION
+    import aiohttp  # Deferred so cache-hit runs never pay the import
+    if _SESSION is None or _SESSION.closed:
+        # One connector for all agents: the three per-round posts ride the same
+        # pool of warm connections instead of handshaking every call.
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=600)
         )
+        atexit.register(_close_session)
+    return _SESSION
 
-        elapsed = time.time() - start_time
+def _close_session():
+    if _SESSION is not None and not _SESSION.closed:
+        # The loop that created the session is gone by atexit time; a throwaway
+        # loop is enough to let aiohttp release its connections cleanly.
+        asyncio.new_event_loop().run_until_complete(_SESSION.close())
 
-        if process.returncode != 0:
-            return {"agent": name, "status": "error", "error": stderr.decode().strip(), "latency": elapsed}
+def extract_payload(body: bytes):
+    """Parses the /api/generate envelope without deserializing the "context" array.
 
+    The context field (token IDs Ollama returns for KV reuse) routinely makes up
+    most of the payload and is never read here, so everything from it onward is
+    sliced off before parsing. Falls back to a full parse if the sliced bytes do
+    not form valid JSON.
+    """
+    head, sep, _ = body.partition(b'"context":')
+    if sep:
         try:
-            # Parse the JSON output from Ollama
-            parsed = json.loads(stdout.decode(errors="ignore"))
-            
-            # Normalize the output (we expect specific keys based on your prompt)
-            # If the model wraps it in "response", we try to parse that inner string or use it directly
-            if "claim" in parsed and "confidence" in parsed:
-                return {"agent": name, "status": "ok", "output": parsed, "latency": elapsed}
-            else:
-                 # Fallback for unexpected structures
-                return {"agent": name, "status": "ok", "output": parsed, "latency": elapsed}
-
-        except json.JSONDecodeError as e:
-            return {"agent": name, "status": "invalid_json", "raw": stdout.decode(), "error": str(e), "latency": elapsed}
+            return orjson.loads(head.rstrip().rstrip(b",") + b"}")
+        except orjson.JSONDecodeError:
+            pass
+    return orjson.loads(body)
 
-    except asyncio.TimeoutError:
-        if process:
+_POOL = None  # CLI-fallback worker pool, created only if the HTTP path is unusable
+
+def _run_ollama_blocking(model: str, prompt: str, timeout: float):
+    """Runs the ollama CLI synchronously; executed inside a pool worker."""
+    proc = subprocess.run(
+        ["ollama", "run", model, "--format", "json", "--hidethinking", "--keepalive", str(KEEP_ALIVE)],
+        input=prompt.encode(),
+        capture_output=True,
+        timeout=timeout,
+    )
+    return proc.returncode, proc.stdout, proc.stderr
+
+async def _call_agent_cli(name: str, model: str, prompt: str, cache_file, timeout: float):
+    """CLI fallback used when the Ollama server is unreachable.
+
+    The fork/exec runs inside a ProcessPoolExecutor worker, so the event loop
+    never blocks on asyncio's subprocess spawn/SIGCHLD machinery.
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = concurrent.futures.ProcessPoolExecutor(max_workers=len(AGENTS))
+
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        returncode, stdout, stderr = await loop.run_in_executor(
+            _POOL, _run_ollama_blocking, model, prompt, timeout
+        )
+    except subprocess.TimeoutExpired:
+        return {"agent": name, "status": "timeout", "latency": time.perf_counter() - start_time}
+
+    elapsed = time.perf_counter() - start_time
+
+    if returncode != 0:
+        return {"agent": name, "status": "error", "error": stderr.decode().strip(), "latency": elapsed}
+
+    try:
+        parsed = orjson.loads(stdout)
+    except orjson.JSONDecodeError as e:
+        print(f"WARNING: Node {name} returned non-schema output: {e}")
+        return {"agent": name, "status": "error", "error": str(e), "latency": elapsed}
+
+    result = {"agent": name, "status": "ok", "output": parsed, "latency": elapsed}
+
+    if cache_file is not None:
+        _cache_store(cache_file, result)
+
+    return result
+
+async def call_agent(name: str, model: str, prompt: str, timeout: float = TIMEOUT_SECONDS):
+    """Calls Ollama over HTTP (/api/generate) via a shared keep-alive session."""
+    cache_file = None
+    if not os.environ.get("MAGI_NO_CACHE"):
+        cache_file = _cache_path(model, prompt)
+        cached = _cache_load(cache_file)
+        if cached is not None:
+            cached["latency"] = 0.0
+            return cached
+
+    import aiohttp  # Deferred so cache-hit runs never pay the import
+
+    # Monotonic clock: wall-clock (time.time) can jump under NTP and produce
+    # bogus latencies that would mislead downstream gating heuristics
+    start_time = time.perf_counter()
+
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "format": OUTPUT_SCHEMA,
+        "stream": True,
+        "think": False,  # Ensure no thought process leaks into output
+        "keep_alive": KEEP_ALIVE,
+    }
+
+    try:
+        session = await _session()
+        # Serialize and UTF-8-encode the body once with orjson rather than
+        # letting aiohttp run the prompt through the pure-Python json.dumps
+        body = orjson.dumps(payload)
+        async with session.post(
+            OLLAMA_URL,
+            data=body,
+            headers=_JSON_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as resp:
+            if resp.status != 200:
+                error_text = await resp.text()
+                elapsed = time.perf_counter() - start_time
+                return {"agent": name, "status": "error", "error": error_text.strip(), "latency": elapsed}
+
+            # Consume the NDJSON stream as tokens arrive. Once the accumulated
+            # text parses as a complete schema object we stop reading; leaving
+            # the context manager closes the connection and Ollama aborts any
+            # residual generation on its side.
+            fragments = []
+            parsed = None
+            async for line in resp.content:
+                if not line.strip():
+                    continue
+                chunk = extract_payload(line)
+                fragment = chunk.get("response", "")
+                if fragment:
+                    fragments.append(fragment)
+                    if fragment.rstrip().endswith("}"):
+                        try:
+                            candidate = orjson.loads("".join(fragments))
+                        except orjson.JSONDecodeError:
+                            continue
+                        if isinstance(candidate, dict) and "claim" in candidate and "confidence" in candidate:
+                            parsed = candidate
+                            break
+                if chunk.get("done"):
+                    break
+
+        elapsed = time.perf_counter() - start_time
+
+        if parsed is None:
+            # Constrained decoding means this parse cannot fail in practice;
+            # the guard below only exists to log server-side bugs.
             try:
-                process.kill()
-                await process.wait()
-            except ProcessLookupError:
-                pass
-        return {"agent": name, "status": "timeout", "latency": TIMEOUT_SECONDS}
+                parsed = orjson.loads("".join(fragments))
+            except orjson.JSONDecodeError as e:
+                print(f"WARNING: Node {name} returned non-schema output: {e}")
+                return {"agent": name, "status": "error", "error": str(e), "latency": elapsed}
+
+        result = {"agent": name, "status": "ok", "output": parsed, "latency": elapsed}
+
+        if cache_file is not None:
+            _cache_store(cache_file, result)
+
+        return result
+
+    except asyncio.TimeoutError:
+        return {"agent": name, "status": "timeout", "latency": time.perf_counter() - start_time}
+
+    except aiohttp.ClientConnectionError:
+        # No server listening (e.g. ollama serve not running): degrade to the CLI
+        return await _call_agent_cli(name, model, prompt, cache_file, timeout)
 
-def create_bridge_prompt(agent_name, original_prompt, results_map):
+    except aiohttp.ClientError as e:
+        return {"agent": name, "status": "error", "error": str(e), "latency": time.perf_counter() - start_time}
+
+def create_bridge_prefix(original_prompt):
+    """
+    Builds the part of the Round-2 prompt that is identical for all three
+    agents, so run_magi_cycle can construct it once per cycle. The stable part
+    (original input + static directive) comes first so all three Round-2 calls
+    share a long common prefix with Round 1; the per-agent peer reports go
+    last, where a cache miss costs the least.
+    """
+    return (
+        f"ORIGINAL INPUT: {original_prompt}\n\n"
+        f"SYSTEM ALERT: DATA SYNCHRONIZATION PHASE.\n"
+        f"DIRECTIVE: Re-evaluate your original calculation based on the peer reports below. "
+        f"If another node identifies a risk or advantage you missed, adjust your parameters. "
+        f"Output your FINAL updated JSON analysis.\n\n"
+        f"PEER REPORTS:\n"
+    )
+
+def create_bridge_prompt(agent_name, bridge_prefix, results_map):
     """
     Constructs the prompt for Round 2.
     It tells the agent what the OTHER two agents said.
     """
-    others_text = ""
-    for name, data in results_map.items():
+    parts = []
+    # Sort for deterministic ordering: Ollama only reuses KV state on an exact
+    # byte-for-byte prefix match, so the prompt must not vary with dict order.
+    for name, data in sorted(results_map.items()):
         if name == agent_name:
             continue
-        
+
         # Format the other agent's output for the prompt
         output = data.get('output', {})
         claim = output.get('claim', 'No claim provided')
         confidence = output.get('confidence', 0.0)
         failure_modes = output.get('failure_modes', [])
-        
-        others_text += f"\n**NODE {name.upper()} REPORT:**\n"
-        others_text += f"- CLAIM: {claim}\n"
-        others_text += f"- CONFIDENCE: {confidence}\n"
-        others_text += f"- FAILURE MODES IDENTIFIED: {', '.join(failure_modes)}\n"
 
-    new_prompt = (
-        f"ORIGINAL INPUT: {original_prompt}\n\n"
-        f"SYSTEM ALERT: DATA SYNCHRONIZATION PHASE.\n"
-        f"The other MAGI nodes have processed the scenario. Review their outputs below:\n"
-        f"{others_text}\n\n"
-        f"DIRECTIVE: Re-evaluate your original calculation based on these variables. "
-        f"If another node identifies a risk or advantage you missed, adjust your parameters. "
-        f"Output your FINAL updated JSON analysis."
-    )
-    return new_prompt
+        # Canonical formatting (fixed-precision confidence, sorted failure
+        # modes) so semantically identical reports always produce the same
+        # bytes — a float repr wobble would bust both the response cache and
+        # the KV-prefix cache.
+        parts.append(f"\n**NODE {name.upper()} REPORT:**\n")
+        parts.append(f"- CLAIM: {claim}\n")
+        parts.append(f"- CONFIDENCE: {confidence:.4f}\n")
+        parts.append(f"- FAILURE MODES IDENTIFIED: {', '.join(sorted(failure_modes))}\n")
+
+    return bridge_prefix + "".join(parts)
 
 async def run_magi_cycle(user_prompt: str):
+    # --- SEMANTIC CACHE LOOKUP ---
+    query_vec = None
+    if not os.environ.get("MAGI_NO_CACHE"):
+        try:
+            query_vec, cached = _semantic_lookup(user_prompt)
+        except ImportError:
+            cached = None  # sentence-transformers/numpy not installed; skip the semantic layer
+        if cached is not None:
+            print(f"\n[MAGI_SYS] SEMANTIC CACHE HIT. REUSING PRIOR DELIBERATION.")
+            return cached
+
     print(f"\n[MAGI_SYS] INITIALIZING ROUND 1: BLIND ANALYSIS...")
-    
+
     # --- ROUND 1: PARALLEL CALLS ---
-    tasks_r1 = [call_agent(name, model, user_prompt) for name, model in AGENTS.items()]
-    results_r1_list = await asyncio.gather(*tasks_r1)
-    
+    tasks_r1 = {
+        name: asyncio.create_task(call_agent(name, model, user_prompt))
+        for name, model in AGENTS.items()
+    }
+
+    # The stable prompt prefix is identical for all agents; build it once
+    bridge_prefix = create_bridge_prefix(user_prompt)
+
+    async def rerun_agent(name: str, model: str):
+        # An agent's bridge prompt only needs its two PEER reports, so Round 2
+        # for each node starts as soon as the other two finish Round 1 — its
+        # own Round-1 call (or the slowest node's) may still be generating.
+        peers = await asyncio.gather(*(tasks_r1[p] for p in AGENTS if p != name))
+        peer_map = {r['agent']: r for r in peers if r['status'] == 'ok'}
+        if len(peer_map) < len(AGENTS) - 1:
+            return None  # A peer failed Round 1; the whole cycle aborts below
+        bridge_prompt = create_bridge_prompt(name, bridge_prefix, peer_map)
+        # Round 2 rarely runs longer than 1.5x Round 1 on the same models, so
+        # scale the timeout from the peer latencies seen so far (the full
+        # Round-1 picture isn't in yet) instead of waiting out the static cap
+        r2_timeout = max(30.0, 1.5 * max(r['latency'] for r in peer_map.values()))
+        return await call_agent(name, model, bridge_prompt, timeout=r2_timeout)
+
+    # --- ROUND 2: DEBATE / RE-EVALUATION (armed before Round 1 completes) ---
+    tasks_r2 = {
+        name: asyncio.create_task(rerun_agent(name, model))
+        for name, model in AGENTS.items()
+    }
+
+    results_r1_list = await asyncio.gather(*tasks_r1.values())
+
     # Map results by agent name for easy access
     results_r1_map = {r['agent']: r for r in results_r1_list if r['status'] == 'ok'}
-    
+
+    async def _abandon_round_2():
+        for task in tasks_r2.values():
+            task.cancel()
+        # Reap the cancellations; client disconnect makes Ollama abort generation
+        await asyncio.gather(*tasks_r2.values(), return_exceptions=True)
+
     if len(results_r1_map) < 3:
+        await _abandon_round_2()
         print("CRITICAL ERROR: Not all nodes responded in Round 1.")
         return
 
+    # --- CONSENSUS SHORT-CIRCUIT ---
+    # If every node already reports high confidence, a second round rarely moves
+    # the aggregate; abandoning here saves the three Round-2 calls.
+    if not os.environ.get("MAGI_FORCE_R2"):
+        confidences = [r['output'].get('confidence', 0.0) for r in results_r1_map.values()]
+        if min(confidences) >= CONSENSUS_THRESHOLD:
+            await _abandon_round_2()
+            print(f"[MAGI_SYS] ROUND 1 CONSENSUS REACHED (MIN CONFIDENCE {min(confidences):.2f}). SKIPPING ROUND 2.")
+            final_results = list(results_r1_map.values())
+            if query_vec is not None:
+                _semantic_store(query_vec, user_prompt, final_results)
+            return final_results
+
     print(f"[MAGI_SYS] ROUND 1 COMPLETE. SYNCHRONIZING DATA...")
+    print(f"[MAGI_SYS] CONTINUING ROUND 2: CROSS-REFERENCE & DEBATE...")
 
-    # --- ROUND 2: DEBATE / RE-EVALUATION ---
-    tasks_r2 = []
-    for name, model in AGENTS.items():
-        # Create unique prompt for each agent containing the others' opinions
-        bridge_prompt = create_bridge_prompt(name, user_prompt, results_r1_map)
-        tasks_r2.append(call_agent(name, model, bridge_prompt))
+    results_r2_list = await asyncio.gather(*tasks_r2.values())
 
-    print(f"[MAGI_SYS] INITIALIZING ROUND 2: CROSS-REFERENCE & DEBATE...")
-    results_r2_list = await asyncio.gather(*tasks_r2)
-    
     # Process Final Results
     final_results = []
-    for r in results_r2_list:
-        if r['status'] == 'ok':
+    for name, r in zip(tasks_r2, results_r2_list):
+        if r is not None and r['status'] == 'ok':
             final_results.append(r)
         else:
             # Fallback to Round 1 data if Round 2 fails for a node
-            print(f"WARNING: Node {r['agent']} failed round 2. Using cached data.")
-            final_results.append(results_r1_map[r['agent']])
+            print(f"WARNING: Node {name} failed round 2. Using cached data.")
+            final_results.append(results_r1_map[name])
+
+    if query_vec is not None:
+        _semantic_store(query_vec, user_prompt, final_results)
 
     return final_results
 
 def print_magi_report(results):
-    print("\n" + "="*60)
-    print("MAGI SYSTEM: FINAL DELIBERATION REPORT")
-    print("="*60 + "\n")
+    # Accumulate the whole report and emit it in one write: a couple dozen
+    # print() calls mean a couple dozen stdout locks and syscalls otherwise
+    lines = []
+    lines.append("\n" + "="*60)
+    lines.append("MAGI SYSTEM: FINAL DELIBERATION REPORT")
+    lines.append("="*60 + "\n")
 
     total_confidence = 0.0
     valid_nodes = 0
 
-    # Print individual Node details
+    # Individual Node details
     for res in results:
         agent = res['agent'].upper()
         data = res.get('output', {})
-        
+
         claim = data.get('claim', 'N/A')
         confidence = data.get('confidence', 0.0)
-        
+
         # Color code based on agent
         prefix = ""
         if "MELCHIOR" in agent: prefix = "[SCIENTIST]"
         elif "BALTHASAR" in agent: prefix = "[MOTHER]"
         elif "CASPER" in agent: prefix = "[WOMAN]"
 
-        print(f"{prefix} {agent}")
-        print(f"CONFIDENCE: {confidence:.2f}")
-        print(f"CLAIM: {claim}")
-        print("-" * 30)
+        lines.append(f"{prefix} {agent}")
+        lines.append(f"CONFIDENCE: {confidence:.2f}")
+        lines.append(f"CLAIM: {claim}")
+        lines.append("-" * 30)
 
         total_confidence += confidence
         valid_nodes += 1
@@ -171,10 +488,9 @@ def print_magi_report(results):
     else:
         avg_score = 0.0
 
-    print("\n" + "="*60)
-    print(f"AGGREGATE CONFIDENCE SCORE: {avg_score:.4f}")
-    
-    status = ""
+    lines.append("\n" + "="*60)
+    lines.append(f"AGGREGATE CONFIDENCE SCORE: {avg_score:.4f}")
+
     if avg_score >= 0.7:
         status = ">> RESOLUTION: UNANIMOUS APPROVAL <<"
     elif avg_score >= 0.5:
@@ -184,8 +500,10 @@ def print_magi_report(results):
     else:
         status = ">> RESOLUTION: REJECTION <<"
 
-    print(status)
-    print("="*60 + "\n")
+    lines.append(status)
+    lines.append("="*60 + "\n")
+
+    sys.stdout.write("\n".join(lines) + "\n")
 
 def main():
     if len(sys.argv) > 1: